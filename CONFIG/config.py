@@ -30,6 +30,10 @@ class Config:
         'sqlite:///' + os.path.join(os.path.dirname(__file__), '..', 'avatararts.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Catalog database populated by `flask catalog import`
+    CATALOG_DATABASE = os.environ.get('CATALOG_DATABASE') or \
+        os.path.join(os.path.dirname(__file__), '..', 'avatararts.db')
+    
     # Redis Configuration (if using Redis for caching)
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379/0'
     
@@ -0,0 +1,3 @@
+"""
+AvatarArts Website Flask application: site routes, catalog, dedup and sitemap
+"""
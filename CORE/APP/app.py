@@ -4,11 +4,22 @@ Creative Automation Platform for Steven Chaplinski
 """
 
 import os
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import (Flask, render_template, request, jsonify, send_from_directory,
+                   abort, make_response, url_for, Response)
 from datetime import datetime
+import hashlib
+import itertools
 import json
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
+from CONFIG.config import Config as SiteConfig
+
+from . import catalog
+from . import dedup
+from . import sitemap
+
 # Initialize Flask app
 app = Flask(__name__, 
             template_folder='../TEMPLATES',
@@ -21,11 +32,46 @@ class Config:
     # nocTurneMeLoDieS V4 integration settings
     NOCTURNEMELODIES_PATH = '/Users/steven/Music/nocTurneMeLoDieS'
     AVATARARTS_V4_PATH = '/Users/steven/Music/nocTurneMeLoDieS/github.com/ichoake/AvaTar-Arts/V4_SUNO_INTEGRATION'
+    # Catalog database and built-in collections are defined once in CONFIG/config.py
+    CATALOG_DATABASE = SiteConfig.CATALOG_DATABASE
+    SPECIAL_COLLECTIONS = SiteConfig.SPECIAL_COLLECTIONS
+    # Minimum estimated similarity for two tracks to count as duplicates
+    DEDUP_THRESHOLD = float(os.environ.get('DEDUP_THRESHOLD') or dedup.DEFAULT_THRESHOLD)
+    # Detail page caching
+    PAGE_CACHE_SIZE = 2048  # rendered pages kept in memory per worker
+    PAGE_CACHE_TIMEOUT = 300  # 5 minutes
+    DETAIL_PAGE_SIZE = 100  # albums or tracks listed per page
+    SITEMAP_CACHE_TIMEOUT = 3600  # 1 hour
 
 # Apply configuration
 app.config.from_object(Config)
+catalog.init_app(app)
 
 # Import nocTurneMeLoDieS V4 data
+def get_builtin_collections(conn):
+    """Built-in special collections that have no imported catalog record"""
+    return {
+        slug: data for slug, data in app.config['SPECIAL_COLLECTIONS'].items()
+        if catalog.get_entity(conn, 'collection', slug) is None
+    }
+
+def get_special_collections():
+    """
+    Get special collections: the built-in ones plus every imported collection.
+
+    Imported records replace built-ins with the same slug, matching what the
+    collection pages and the sitemap serve.
+    """
+    conn = catalog.get_db()
+    special_collections = dict(app.config['SPECIAL_COLLECTIONS'])
+    for row in catalog.iter_rows(conn, 'collection'):
+        special_collections[row['slug']] = {
+            "name": row['name'],
+            "track_count": row['track_count'],
+            "primary_theme": row['primary_theme']
+        }
+    return special_collections
+
 def get_avatararts_collection():
     """Get AvatarArts collection data from V4 system"""
     try:
@@ -33,36 +79,12 @@ def get_avatararts_collection():
         # For now, we'll return mock data based on the V4 system
         collection_data = {
             "total_tracks": 1184,
+            # Without catalog data there is nothing to deduplicate against
+            "unique_tracks": 1184,
             "total_albums": 665,
             "total_repositories": 12,
             "avatararts_repositories": 3,
-            "special_collections": {
-                "alley_chronicles": {
-                    "name": "Alley Chronicles",
-                    "track_count": 151,
-                    "primary_theme": "Urban Mythology"
-                },
-                "willow_variations": {
-                    "name": "Willow Variations", 
-                    "track_count": 47,
-                    "primary_theme": "Nature Mythology"
-                },
-                "summer_remixes": {
-                    "name": "Summer Remixes",
-                    "track_count": 34,
-                    "primary_theme": "Emotional Journey"
-                },
-                "hero_collections": {
-                    "name": "Hero Collections",
-                    "track_count": 30,
-                    "primary_theme": "Hero Mythology"
-                },
-                "junkyard_symphonies": {
-                    "name": "Junkyard Symphonies",
-                    "track_count": 50,
-                    "primary_theme": "Urban Mythology"
-                }
-            },
+            "special_collections": get_special_collections(),
             "avatararts_themes": [
                 "Urban Mythology",
                 "Nature Mythology", 
@@ -84,6 +106,17 @@ def get_avatararts_collection():
             },
             "last_updated": datetime.now().isoformat()
         }
+
+        # Prefer imported catalog data over the built-in figures when present
+        conn = catalog.get_db()
+        counts = catalog.get_catalog_counts(conn)
+        if counts['track']:
+            collection_data["total_tracks"] = counts['track']
+            # Maintained by `flask catalog duplicates`, never computed per request
+            collection_data["unique_tracks"] = int(catalog.get_state(
+                conn, dedup.UNIQUE_TRACKS_KEY, counts['track']))
+        if counts['album']:
+            collection_data["total_albums"] = counts['album']
         return collection_data
     except Exception as e:
         print(f"Error loading AvatarArts collection: {str(e)}")
@@ -252,11 +285,209 @@ def api_insights():
     insights = get_avatararts_insights()
     return jsonify(insights)
 
+@app.route('/api/duplicates')
+def api_duplicates():
+    """API endpoint for the near-duplicate track cluster report"""
+    report = dedup.duplicate_report(catalog.get_db(), limit=100)
+    return jsonify(report)
+
 @app.route('/favicon.ico')
 def favicon():
     """Serve favicon"""
     return send_from_directory('../STATIC/IMAGES', 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
+# Detail pages
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+
+def render_cached_page(key, version, render):
+    """Serve a rendered page, reusing cached HTML while the entity version is unchanged"""
+    with _page_cache_lock:
+        cached = _page_cache.get(key)
+        if cached is not None and cached[0] == version:
+            _page_cache.move_to_end(key)
+            html = cached[1]
+        else:
+            html = None
+
+    if html is None:
+        html = render()
+        with _page_cache_lock:
+            _page_cache[key] = (version, html)
+            _page_cache.move_to_end(key)
+            while len(_page_cache) > app.config['PAGE_CACHE_SIZE']:
+                _page_cache.popitem(last=False)
+
+    response = make_response(html)
+    response.set_etag(hashlib.md5(repr((key, version)).encode('utf-8')).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['PAGE_CACHE_TIMEOUT']
+    return response.make_conditional(request)
+
+def get_page_number():
+    """Get the 1-based page number from the query string, or 404 if it is not one"""
+    page = request.args.get('page', '1')
+    # int() would also accept signs, spaces and underscores; no page has ten digits
+    if not (page.isascii() and page.isdigit()) or len(page) > 9 or int(page) < 1:
+        abort(404)
+    return int(page)
+
+@app.route('/collection/<slug>')
+def collection_detail(slug):
+    """Special collection page listing its albums"""
+    conn = catalog.get_db()
+    entity = catalog.get_entity(conn, 'collection', slug)
+    if entity is None:
+        # Fall back to the built-in special collections
+        fallback = app.config['SPECIAL_COLLECTIONS'].get(slug)
+        if fallback is None:
+            abort(404)
+        entity = dict(fallback, slug=slug, updated_at=0.0)
+
+    page = get_page_number()
+    album_count, albums_updated = catalog.children_summary(conn, 'album', slug)
+    version = (entity['updated_at'], albums_updated, album_count)
+
+    def render():
+        per_page = app.config['DETAIL_PAGE_SIZE']
+        albums = catalog.list_children(conn, 'album', slug, per_page, (page - 1) * per_page)
+        if page > 1 and not albums:
+            abort(404)
+        return render_template('collection_detail.html',
+                               special_collection=entity,
+                               albums=albums,
+                               album_count=album_count,
+                               page=page,
+                               per_page=per_page,
+                               current_year=datetime.now().year)
+
+    return render_cached_page(('collection', slug, page), version, render)
+
+@app.route('/album/<album_id>')
+def album_detail(album_id):
+    """Album page listing its tracks"""
+    conn = catalog.get_db()
+    album = catalog.get_entity(conn, 'album', album_id)
+    if album is None:
+        abort(404)
+
+    page = get_page_number()
+    track_count, tracks_updated = catalog.children_summary(conn, 'track', album_id)
+    version = (album['updated_at'], tracks_updated, track_count)
+
+    def render():
+        per_page = app.config['DETAIL_PAGE_SIZE']
+        tracks = catalog.list_children(conn, 'track', album_id, per_page, (page - 1) * per_page)
+        if page > 1 and not tracks:
+            abort(404)
+        return render_template('album.html',
+                               album=album,
+                               tracks=tracks,
+                               track_count=track_count,
+                               page=page,
+                               per_page=per_page,
+                               current_year=datetime.now().year)
+
+    return render_cached_page(('album', album_id, page), version, render)
+
+@app.route('/track/<track_id>')
+def track_detail(track_id):
+    """Track page"""
+    conn = catalog.get_db()
+    track = catalog.get_entity(conn, 'track', track_id)
+    if track is None:
+        abort(404)
+
+    # The page shows the album title, so an album edit must change the version too
+    album = catalog.get_entity(conn, 'album', track['album_id']) if track['album_id'] else None
+    version = (track['updated_at'], album['updated_at'] if album else None)
+
+    def render():
+        return render_template('track.html',
+                               track=track,
+                               album=album,
+                               current_year=datetime.now().year)
+
+    return render_cached_page(('track', track_id), version, render)
+
+# Sitemap
+STATIC_PAGES = ('index', 'about', 'collection', 'technology', 'contact')
+SITEMAP_ENTITIES = {
+    'collection': ('collection_detail', 'slug'),
+    'album': ('album_detail', 'album_id'),
+    'track': ('track_detail', 'track_id')
+}
+
+def sitemap_url_template(entity):
+    """External URL for an entity type with a placeholder for its key"""
+    endpoint, argument = SITEMAP_ENTITIES[entity]
+    return url_for(endpoint, _external=True, **{argument: sitemap.URL_PLACEHOLDER})
+
+def sitemap_page_urls(conn):
+    """Static pages plus built-in special collections missing from the catalog"""
+    urls = [(url_for(endpoint, _external=True), None) for endpoint in STATIC_PAGES]
+    template = sitemap_url_template('collection')
+    for slug in get_builtin_collections(conn):
+        urls.append((template.replace(sitemap.URL_PLACEHOLDER, slug), None))
+    return urls
+
+def sitemap_response(chunks):
+    """Stream sitemap XML without building the document in memory"""
+    response = Response(chunks, mimetype='application/xml')
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['SITEMAP_CACHE_TIMEOUT']
+    return response
+
+def stream_entity_urls(entities, shard=None):
+    """
+    Yield (loc, lastmod) chunks for the given entity types.
+
+    The request's catalog connection is closed before a streamed body is
+    consumed, so the generator opens and closes its own.
+    """
+    templates = {entity: sitemap_url_template(entity) for entity in entities}
+    database = app.config['CATALOG_DATABASE']
+
+    def generate():
+        conn = catalog.connect(database)
+        try:
+            for entity, template in templates.items():
+                yield from sitemap.iter_entity_urls(conn, entity, template, shard)
+        finally:
+            conn.close()
+
+    return generate()
+
+@app.route('/sitemap.xml')
+def sitemap_xml():
+    """Sitemap, or a sitemap index of shards when there are too many URLs"""
+    conn = catalog.get_db()
+    bounds = {entity: sitemap.max_rowid(conn, entity) for entity in SITEMAP_ENTITIES}
+    page_urls = sitemap_page_urls(conn)
+
+    if len(page_urls) + sum(bounds.values()) > sitemap.SITEMAP_MAX_URLS:
+        locs = [url_for('sitemap_shard', kind='pages', shard=0, _external=True)]
+        for entity, bound in bounds.items():
+            locs.extend(url_for('sitemap_shard', kind=entity, shard=shard, _external=True)
+                        for shard in range(sitemap.shard_count(bound)))
+        return sitemap_response(sitemap.stream_index(locs))
+
+    chunks = itertools.chain([page_urls], stream_entity_urls(SITEMAP_ENTITIES))
+    return sitemap_response(sitemap.stream_urlset(chunks))
+
+@app.route('/sitemap-<any(pages, collection, album, track):kind>-<int:shard>.xml')
+def sitemap_shard(kind, shard):
+    """One shard of a sitemap index"""
+    conn = catalog.get_db()
+    if kind == 'pages':
+        if shard != 0:
+            abort(404)
+        return sitemap_response(sitemap.stream_urlset([sitemap_page_urls(conn)]))
+
+    if shard >= sitemap.shard_count(sitemap.max_rowid(conn, kind)):
+        abort(404)
+    return sitemap_response(sitemap.stream_urlset(stream_entity_urls([kind], shard)))
+
 @app.route('/robots.txt')
 def robots():
     """Serve robots.txt"""
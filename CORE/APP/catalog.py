@@ -0,0 +1,477 @@
+"""
+AvatarArts Catalog - SQLite-backed store for collections, albums and tracks
+Provides the `flask catalog import/export` commands for bulk NDJSON/CSV data
+"""
+
+import contextlib
+import csv
+import json
+import math
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import click
+from flask import current_app, g
+from flask.cli import AppGroup
+
+# Rows buffered before each upsert transaction is committed
+DEFAULT_BATCH_SIZE = 20000
+
+# Column order for each record type; the first column is the primary key
+ENTITY_FIELDS = {
+    'collection': ('slug', 'name', 'track_count', 'primary_theme'),
+    'album': ('id', 'title', 'collection', 'theme', 'track_count'),
+    'track': ('id', 'title', 'album_id', 'collection', 'repository', 'theme',
+              'genre', 'mood', 'duration_seconds', 'lyrics', 'audio_fingerprint'),
+}
+ENTITY_TABLES = {'collection': 'collections', 'album': 'albums', 'track': 'tracks'}
+REQUIRED_FIELDS = {
+    'collection': ('slug', 'name'),
+    'album': ('id', 'title'),
+    'track': ('id', 'title'),
+}
+INTEGER_FIELDS = {'track_count'}
+FLOAT_FIELDS = {'duration_seconds'}
+# SQLite stores integers as signed 64-bit values
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+SLUG_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]*$')
+# Album and track ids appear as URL path segments, so keep them to unreserved characters
+ID_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._~-]*$')
+# Fields that become (or link to) page URLs and the pattern each must match
+KEY_PATTERNS = {
+    ('collection', 'slug'): SLUG_PATTERN,
+    ('album', 'id'): ID_PATTERN,
+    ('album', 'collection'): SLUG_PATTERN,
+    ('track', 'id'): ID_PATTERN,
+    ('track', 'album_id'): ID_PATTERN,
+    ('track', 'collection'): SLUG_PATTERN,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (
+    slug TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    track_count INTEGER,
+    primary_theme TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    collection TEXT,
+    theme TEXT,
+    track_count INTEGER,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    album_id TEXT,
+    collection TEXT,
+    repository TEXT,
+    theme TEXT,
+    genre TEXT,
+    mood TEXT,
+    duration_seconds REAL,
+    lyrics TEXT,
+    audio_fingerprint TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_albums_collection ON albums (collection);
+CREATE INDEX IF NOT EXISTS idx_tracks_album ON tracks (album_id);
+CREATE INDEX IF NOT EXISTS idx_tracks_collection ON tracks (collection);
+CREATE INDEX IF NOT EXISTS idx_tracks_updated ON tracks (updated_at);
+
+-- Duplicate detection state, maintained by dedup.update_duplicates()
+CREATE TABLE IF NOT EXISTS track_signatures (
+    track_id TEXT PRIMARY KEY,
+    signature BLOB,
+    cluster_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_track_signatures_cluster ON track_signatures (cluster_id);
+CREATE TABLE IF NOT EXISTS track_clusters (
+    cluster_id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_track_clusters_size ON track_clusters (size, cluster_id);
+-- One representative track per (LSH band, cluster), so bucket lookups stay
+-- bounded by the number of clusters rather than the number of duplicates
+CREATE TABLE IF NOT EXISTS cluster_bands (
+    band_key INTEGER NOT NULL,
+    cluster_id TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    PRIMARY KEY (band_key, cluster_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_cluster_bands_cluster ON cluster_bands (cluster_id);
+CREATE TABLE IF NOT EXISTS catalog_state (
+    key TEXT PRIMARY KEY,
+    value REAL
+);
+"""
+
+
+class CatalogRecordError(ValueError):
+    """Raised when an imported record fails validation"""
+
+
+# Database paths whose schema this process has already created
+_initialized_paths = set()
+_init_lock = threading.Lock()
+
+
+def init_db(conn):
+    """Switch a catalog database to WAL and create any missing tables"""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+
+
+def connect(path):
+    """
+    Open a catalog database.
+
+    The schema is only created on the first connection to each path in this
+    process, so request connections just open the file.
+    """
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if path == ':memory:' or path not in _initialized_paths:
+        with _init_lock:
+            if path == ':memory:' or path not in _initialized_paths:
+                init_db(conn)
+                _initialized_paths.add(path)
+    return conn
+
+
+def get_db():
+    """Get the catalog connection for the current app context"""
+    if 'catalog_db' not in g:
+        g.catalog_db = connect(current_app.config['CATALOG_DATABASE'])
+    return g.catalog_db
+
+
+def close_db(error=None):
+    """Close the catalog connection at the end of the app context"""
+    conn = g.pop('catalog_db', None)
+    if conn is not None:
+        conn.close()
+
+
+def _upsert_sql(entity):
+    """Build the INSERT ... ON CONFLICT statement for a record type"""
+    fields = ENTITY_FIELDS[entity]
+    table = ENTITY_TABLES[entity]
+    columns = fields + ('updated_at',)
+    updates = ', '.join(f'{column} = excluded.{column}' for column in columns[1:])
+    # Leave unchanged rows alone so updated_at only moves when data does
+    changed = ' OR '.join(f'{table}.{column} IS NOT excluded.{column}' for column in fields[1:])
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT({fields[0]}) DO UPDATE SET {updates} WHERE {changed}"
+    )
+
+
+UPSERT_SQL = {entity: _upsert_sql(entity) for entity in ENTITY_FIELDS}
+
+
+def validate_record(record, default_type=None):
+    """Validate a raw record and return (entity, row tuple) ready for upsert"""
+    if not isinstance(record, dict):
+        raise CatalogRecordError('record must be an object')
+    entity = record.get('type') or default_type
+    if entity not in ENTITY_FIELDS:
+        raise CatalogRecordError(f'unknown record type: {entity!r}')
+
+    row = []
+    for field in ENTITY_FIELDS[entity]:
+        value = record.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        if value == '':
+            value = None
+        if value is None:
+            if field in REQUIRED_FIELDS[entity]:
+                raise CatalogRecordError(f'{entity} is missing required field {field!r}')
+        elif isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise CatalogRecordError(
+                f'{field} must be a string or number, got {type(value).__name__}')
+        elif field in INTEGER_FIELDS:
+            if isinstance(value, float) and not value.is_integer():
+                raise CatalogRecordError(f'{field} must be an integer, got {value!r}')
+            try:
+                value = int(value)
+            except (ValueError, OverflowError):
+                raise CatalogRecordError(f'{field} must be an integer, got {value!r}')
+            if value < 0:
+                raise CatalogRecordError(f'{field} must not be negative')
+            if value > SQLITE_MAX_INTEGER:
+                raise CatalogRecordError(f'{field} is too large, got {value}')
+        elif field in FLOAT_FIELDS:
+            try:
+                value = float(value)
+            except (ValueError, OverflowError):
+                raise CatalogRecordError(f'{field} must be a number, got {value!r}')
+            if not math.isfinite(value) or value < 0:
+                raise CatalogRecordError(f'{field} must be a finite, non-negative number')
+        else:
+            value = str(value)
+            try:
+                value.encode('utf-8')
+            except UnicodeEncodeError:
+                # e.g. lone surrogates, which json.loads accepts but SQLite cannot store
+                raise CatalogRecordError(f'{field} is not valid UTF-8 text')
+            pattern = KEY_PATTERNS.get((entity, field))
+            if pattern is not None and not pattern.match(value):
+                raise CatalogRecordError(f'invalid {field}: {value!r}')
+        row.append(value)
+
+    return entity, tuple(row)
+
+
+def read_ndjson(stream):
+    """Yield (line number, record) pairs from an NDJSON stream"""
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, CatalogRecordError(f'invalid JSON: {e.msg}')
+
+
+def read_csv(stream):
+    """Yield (line number, record) pairs from a CSV stream with a header row"""
+    reader = csv.DictReader(stream)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def import_records(conn, records, default_type=None, batch_size=DEFAULT_BATCH_SIZE,
+                   on_progress=None, on_error=None):
+    """
+    Upsert records into the catalog in batched transactions.
+
+    Only one batch is held in memory at a time. Each batch is committed
+    atomically, so an interrupted import keeps every completed batch.
+    Imports are idempotent: re-running a file rewrites nothing that is
+    already up to date, and records whose data is unchanged keep their
+    updated_at.
+    """
+    pending = {entity: [] for entity in ENTITY_FIELDS}
+    stats = {'imported': 0, 'rejected': 0}
+    buffered = 0
+
+    def flush():
+        with conn:
+            for entity, rows in pending.items():
+                if rows:
+                    conn.executemany(UPSERT_SQL[entity], rows)
+                    rows.clear()
+
+    for line_number, record in records:
+        try:
+            if isinstance(record, CatalogRecordError):
+                raise record
+            entity, row = validate_record(record, default_type)
+        except CatalogRecordError as e:
+            stats['rejected'] += 1
+            if on_error:
+                on_error(line_number, e)
+            continue
+
+        pending[entity].append(row + (time.time(),))
+        buffered += 1
+        if buffered >= batch_size:
+            flush()
+            stats['imported'] += buffered
+            buffered = 0
+            if on_progress:
+                on_progress(stats)
+
+    if buffered:
+        flush()
+        stats['imported'] += buffered
+        if on_progress:
+            on_progress(stats)
+    return stats
+
+
+def iter_rows(conn, entity, chunk_size=DEFAULT_BATCH_SIZE):
+    """Yield catalog rows of one type as dicts, fetching in bounded chunks"""
+    fields = ENTITY_FIELDS[entity]
+    cursor = conn.execute(
+        f"SELECT {', '.join(fields)} FROM {ENTITY_TABLES[entity]} ORDER BY {fields[0]}"
+    )
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(fields, row))
+
+
+# Indexed columns child listings may be filtered on
+CHILD_COLUMNS = {'album': 'collection', 'track': 'album_id'}
+
+
+def get_entity(conn, entity, key):
+    """Look up one catalog record by primary key, or None if missing"""
+    fields = ENTITY_FIELDS[entity] + ('updated_at',)
+    row = conn.execute(
+        f"SELECT {', '.join(fields)} FROM {ENTITY_TABLES[entity]} WHERE {fields[0]} = ?",
+        (key,)
+    ).fetchone()
+    return dict(zip(fields, row)) if row else None
+
+
+def list_children(conn, entity, parent_key, limit, offset=0):
+    """List records of one type belonging to a parent collection or album"""
+    fields = ENTITY_FIELDS[entity]
+    cursor = conn.execute(
+        f"SELECT {', '.join(fields)} FROM {ENTITY_TABLES[entity]} "
+        f"WHERE {CHILD_COLUMNS[entity]} = ? ORDER BY {fields[1]}, {fields[0]} LIMIT ? OFFSET ?",
+        (parent_key, limit, offset)
+    )
+    return [dict(zip(fields, row)) for row in cursor]
+
+
+def children_summary(conn, entity, parent_key):
+    """Return (count, latest updated_at) for a parent's child records"""
+    count, latest = conn.execute(
+        f"SELECT COUNT(*), MAX(updated_at) FROM {ENTITY_TABLES[entity]} "
+        f"WHERE {CHILD_COLUMNS[entity]} = ?",
+        (parent_key,)
+    ).fetchone()
+    return count, latest or 0.0
+
+
+def get_state(conn, key, default=None):
+    """Read a stored catalog-wide value, such as the unique track count"""
+    row = conn.execute('SELECT value FROM catalog_state WHERE key = ?', (key,)).fetchone()
+    return row[0] if row is not None and row[0] is not None else default
+
+
+def set_state(conn, key, value):
+    """Store a catalog-wide value; the caller owns the transaction"""
+    conn.execute(
+        'INSERT INTO catalog_state (key, value) VALUES (?, ?) '
+        'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+        (key, value)
+    )
+
+
+def get_catalog_counts(conn):
+    """Return row counts for each catalog table"""
+    return {
+        entity: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        for entity, table in ENTITY_TABLES.items()
+    }
+
+
+def _open_stream(filename, mode):
+    """Open a file for streaming, treating '-' as stdin/stdout"""
+    if filename == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return contextlib.nullcontext(stream)
+    return open(filename, mode, encoding='utf-8', newline='')
+
+
+def _detect_format(filename, file_format):
+    if file_format:
+        return file_format
+    return 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+
+
+# Flask CLI commands
+catalog_cli = AppGroup('catalog', help='Bulk import and export of catalog data.')
+
+
+@catalog_cli.command('import')
+@click.argument('source', default='-')
+@click.option('--format', 'file_format', type=click.Choice(['ndjson', 'csv']),
+              help='Input format (defaults to the file extension, else NDJSON).')
+@click.option('--type', 'default_type', type=click.Choice(list(ENTITY_FIELDS)),
+              help='Record type for rows without a "type" field.')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              type=click.IntRange(min=1), help='Records per transaction.')
+def import_command(source, file_format, default_type, batch_size):
+    """Stream NDJSON or CSV records from SOURCE (or stdin) into the catalog."""
+    file_format = _detect_format(source, file_format)
+    conn = get_db()
+    started = time.monotonic()
+    reported_errors = [0]
+
+    def on_progress(stats):
+        elapsed = time.monotonic() - started
+        rate = stats['imported'] / elapsed if elapsed else 0
+        click.echo(f"Imported {stats['imported']:,} records "
+                   f"({stats['rejected']:,} rejected, {rate:,.0f}/s)", err=True)
+
+    def on_error(line_number, error):
+        # Cap error output so a badly formed file cannot flood the terminal
+        reported_errors[0] += 1
+        if reported_errors[0] <= 100:
+            click.echo(f'Line {line_number}: {error}', err=True)
+
+    with _open_stream(source, 'r') as stream:
+        records = read_csv(stream) if file_format == 'csv' else read_ndjson(stream)
+        try:
+            stats = import_records(conn, records, default_type, batch_size,
+                                   on_progress=on_progress, on_error=on_error)
+        except KeyboardInterrupt:
+            click.echo('Import interrupted; completed batches were kept, '
+                       'the current batch was rolled back.', err=True)
+            sys.exit(130)
+
+    elapsed = time.monotonic() - started
+    click.echo(f"Done: {stats['imported']:,} imported, {stats['rejected']:,} rejected "
+               f"in {elapsed:.1f}s", err=True)
+    if stats['imported']:
+        # Duplicate detection is far slower than the import, so it runs separately
+        click.echo("Run 'flask catalog duplicates' to update duplicate clusters.", err=True)
+    if stats['rejected']:
+        sys.exit(1)
+
+
+@catalog_cli.command('export')
+@click.argument('destination', default='-')
+@click.option('--format', 'file_format', type=click.Choice(['ndjson', 'csv']),
+              help='Output format (defaults to the file extension, else NDJSON).')
+@click.option('--type', 'entity', type=click.Choice(list(ENTITY_FIELDS)),
+              help='Record type to export (required for CSV).')
+def export_command(destination, file_format, entity):
+    """Stream catalog records to DESTINATION (or stdout) as NDJSON or CSV."""
+    file_format = _detect_format(destination, file_format)
+    if file_format == 'csv' and entity is None:
+        raise click.UsageError('CSV export needs --type to choose a single record type.')
+
+    conn = get_db()
+    entities = [entity] if entity else list(ENTITY_FIELDS)
+    exported = 0
+    with _open_stream(destination, 'w') as stream:
+        if file_format == 'csv':
+            writer = csv.DictWriter(stream, fieldnames=ENTITY_FIELDS[entity])
+            writer.writeheader()
+            for row in iter_rows(conn, entity):
+                writer.writerow(row)
+                exported += 1
+        else:
+            for name in entities:
+                for row in iter_rows(conn, name):
+                    record = {'type': name}
+                    record.update((key, value) for key, value in row.items() if value is not None)
+                    stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    exported += 1
+
+    click.echo(f'Exported {exported:,} records', err=True)
+
+
+def init_app(app):
+    """Register the catalog connection teardown and CLI commands"""
+    app.teardown_appcontext(close_db)
+    app.cli.add_command(catalog_cli)
@@ -0,0 +1,421 @@
+"""
+AvatarArts Dedup - near-duplicate track detection with MinHash and LSH
+Groups re-uploads and near-identical variants so stats can report unique tracks
+"""
+
+import hashlib
+import re
+import struct
+import sys
+import time
+import unicodedata
+
+import click
+from flask import current_app
+
+from . import catalog
+
+# Signature size and LSH banding; 16 bands of 4 rows puts the candidate
+# threshold near a Jaccard similarity of 0.5
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // NUM_BANDS
+
+# Estimated Jaccard similarity two candidates need to be treated as duplicates
+DEFAULT_THRESHOLD = 0.7
+
+SHINGLE_SIZE = 4
+FINGERPRINT_CHUNK = 16
+
+# Tracks indexed per transaction; each commit also advances the watermark
+DEFAULT_BATCH_SIZE = 5000
+
+# Catalog state keys written by update_duplicates()
+WATERMARK_KEY = 'dedup_watermark'
+UNIQUE_TRACKS_KEY = 'unique_tracks'
+CLUSTER_COUNT_KEY = 'duplicate_clusters'
+
+_SIGNATURE = struct.Struct(f'<{NUM_PERMUTATIONS}I')
+_BAND = struct.Struct(f'<B{ROWS_PER_BAND}I')
+_EMPTY_BIN = 1 << 32
+
+
+def _probe_order(index):
+    """Fixed pseudo-random order in which an empty bin looks for a filled one"""
+    return sorted(
+        range(NUM_PERMUTATIONS),
+        key=lambda other: hashlib.blake2b(_BAND.pack(index, other, 0, 0, 0), digest_size=8).digest()
+    )
+
+
+# Each empty bin borrows along its own probe order, so runs of empty bins
+# do not all copy the same neighbour and a band needs several shared shingles
+_PROBES = [_probe_order(index) for index in range(NUM_PERMUTATIONS)]
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_text(text):
+    """Casefold text and collapse punctuation to single spaces, keeping letters in any script"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return _NON_WORD.sub(' ', text).strip()
+
+
+def shingle_track(title, lyrics=None, audio_fingerprint=None):
+    """Build the shingle set for a track from its title, lyrics and fingerprint"""
+    shingles = set()
+    for text in (title, lyrics):
+        text = normalize_text(text)
+        if not text:
+            continue
+        if len(text) <= SHINGLE_SIZE:
+            shingles.add(text)
+        else:
+            shingles.update(text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1))
+    if audio_fingerprint:
+        # Prefix fingerprint chunks so they never collide with text shingles
+        fingerprint = audio_fingerprint.strip()
+        shingles.update(
+            'fp:' + fingerprint[i:i + FINGERPRINT_CHUNK]
+            for i in range(0, len(fingerprint), FINGERPRINT_CHUNK)
+        )
+    return shingles
+
+
+def minhash_signature(shingles):
+    """
+    Compute the MinHash signature of a shingle set.
+
+    Uses one-permutation hashing: each shingle is hashed once, the low bits
+    pick a bin and each bin keeps its minimum. Empty bins borrow from a
+    filled bin along a fixed probe order so small sets still give full
+    signatures.
+
+    Returns None for an empty set: such a track has nothing to compare, so
+    it is kept out of the LSH buckets and always counted as unique.
+    """
+    if not shingles:
+        return None
+    bins = [_EMPTY_BIN] * NUM_PERMUTATIONS
+    for shingle in shingles:
+        digest = hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        index = value % NUM_PERMUTATIONS
+        value >>= 32
+        if value < bins[index]:
+            bins[index] = value
+
+    return tuple(
+        value if value != _EMPTY_BIN
+        else next(bins[other] for other in _PROBES[index] if bins[other] != _EMPTY_BIN)
+        for index, value in enumerate(bins)
+    )
+
+
+def estimate_similarity(signature_a, signature_b):
+    """Estimate the Jaccard similarity of two sets from their signatures"""
+    matches = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+    return matches / NUM_PERMUTATIONS
+
+
+def pack_signature(signature):
+    """Serialise a signature for the catalog, or None for an empty one"""
+    return _SIGNATURE.pack(*signature) if signature is not None else None
+
+
+def unpack_signature(blob):
+    """Inverse of pack_signature()"""
+    return _SIGNATURE.unpack(blob) if blob is not None else None
+
+
+def band_keys(signature):
+    """Hash each LSH band of a signature to a 64-bit bucket key"""
+    keys = []
+    for band in range(NUM_BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(_BAND.pack(band, *rows), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, 'little', signed=True))
+    return keys
+
+
+def find_clusters(signatures, threshold=DEFAULT_THRESHOLD):
+    """
+    Group an in-memory {track_id: signature} mapping into duplicate clusters.
+
+    Each LSH bucket keeps one member per cluster, so a track is verified at
+    most once per cluster it shares a band with, however many duplicates
+    that cluster already holds. Returns a mapping of track id to cluster id,
+    the smallest track id in its cluster.
+    """
+    parent = {track_id: track_id for track_id in signatures}
+
+    def find(track_id):
+        while parent[track_id] != track_id:
+            parent[track_id] = parent[parent[track_id]]
+            track_id = parent[track_id]
+        return track_id
+
+    buckets = {}
+    for track_id, signature in signatures.items():
+        if signature is None:
+            continue
+        for key in band_keys(signature):
+            bucket = buckets.setdefault(key, [])
+            represented = False
+            for other_id in bucket:
+                root, other_root = find(track_id), find(other_id)
+                if root == other_root:
+                    represented = True
+                elif estimate_similarity(signature, signatures[other_id]) >= threshold:
+                    parent[max(root, other_root)] = min(root, other_root)
+                    represented = True
+            if not represented:
+                bucket.append(track_id)
+    return {track_id: find(track_id) for track_id in signatures}
+
+
+def _placeholders(values):
+    return ', '.join('?' for _ in values)
+
+
+def _merge_clusters(conn, cluster_ids):
+    """
+    Merge clusters into the largest one and return its id.
+
+    Only the smaller clusters are relabelled, so a track joining a cluster of
+    thousands of re-uploads touches its own rows rather than the whole cluster.
+    """
+    cluster_ids = list(cluster_ids)
+    sizes = dict(conn.execute(
+        f'SELECT cluster_id, size FROM track_clusters WHERE cluster_id IN ({_placeholders(cluster_ids)})',
+        cluster_ids
+    ).fetchall())
+    target = min(sizes, key=lambda cluster_id: (-sizes[cluster_id], cluster_id))
+    others = [cluster_id for cluster_id in sizes if cluster_id != target]
+    in_others = f'WHERE cluster_id IN ({_placeholders(others)})'
+    conn.execute(f'UPDATE track_signatures SET cluster_id = ? {in_others}', [target] + others)
+    # A band the target already holds keeps the target's representative
+    conn.execute(f'UPDATE OR IGNORE cluster_bands SET cluster_id = ? {in_others}', [target] + others)
+    conn.execute(f'DELETE FROM cluster_bands {in_others}', others)
+    conn.execute(f'DELETE FROM track_clusters {in_others}', others)
+    conn.execute('UPDATE track_clusters SET size = ? WHERE cluster_id = ?',
+                 (sum(sizes.values()), target))
+    return target
+
+
+def _add_track(conn, track_id, signature, blob, threshold):
+    """Index a new or changed track and merge it with every verified LSH candidate"""
+    conn.execute('INSERT INTO track_signatures (track_id, signature, cluster_id) VALUES (?, ?, ?)',
+                 (track_id, blob, track_id))
+    conn.execute('INSERT INTO track_clusters (cluster_id, size) VALUES (?, 1)', (track_id,))
+    if signature is None:
+        return
+
+    # Buckets hold one representative per cluster, so the candidates are
+    # bounded by the clusters sharing a band, not by how many tracks they hold
+    keys = band_keys(signature)
+    candidates = conn.execute(
+        f"SELECT b.cluster_id, s.signature FROM cluster_bands b "
+        f"JOIN track_signatures s ON s.track_id = b.track_id "
+        f"WHERE b.band_key IN ({_placeholders(keys)})",
+        keys
+    ).fetchall()
+    matched = {track_id}
+    for cluster_id, other_blob in candidates:
+        if cluster_id not in matched and \
+                estimate_similarity(signature, unpack_signature(other_blob)) >= threshold:
+            matched.add(cluster_id)
+    cluster_id = _merge_clusters(conn, matched) if len(matched) > 1 else track_id
+    conn.executemany(
+        'INSERT OR IGNORE INTO cluster_bands (band_key, cluster_id, track_id) VALUES (?, ?, ?)',
+        [(key, cluster_id, track_id) for key in keys]
+    )
+
+
+def _resettle(conn, cluster_ids, threshold):
+    """Regroup the remaining members of clusters that lost a track, splitting any that fell apart"""
+    cluster_ids = list(cluster_ids)
+    signatures = {}
+    # Stay well under SQLite's bound parameter limit
+    for start in range(0, len(cluster_ids), 500):
+        chunk = cluster_ids[start:start + 500]
+        in_chunk = f'WHERE cluster_id IN ({_placeholders(chunk)})'
+        for track_id, blob in conn.execute(
+                f'SELECT track_id, signature FROM track_signatures {in_chunk}', chunk):
+            signatures[track_id] = unpack_signature(blob)
+        conn.execute(f'DELETE FROM cluster_bands {in_chunk}', chunk)
+        conn.execute(f'DELETE FROM track_clusters {in_chunk}', chunk)
+
+    # Union-find cannot split sets, so regroup the affected members from scratch
+    clusters = find_clusters(signatures, threshold)
+    sizes = {}
+    for cluster_id in clusters.values():
+        sizes[cluster_id] = sizes.get(cluster_id, 0) + 1
+    conn.executemany('UPDATE track_signatures SET cluster_id = ? WHERE track_id = ?',
+                     [(cluster_id, track_id) for track_id, cluster_id in clusters.items()])
+    conn.executemany('INSERT INTO track_clusters (cluster_id, size) VALUES (?, ?)', sizes.items())
+    conn.executemany(
+        'INSERT OR IGNORE INTO cluster_bands (band_key, cluster_id, track_id) VALUES (?, ?, ?)',
+        [(key, clusters[track_id], track_id)
+         for track_id, signature in signatures.items() if signature is not None
+         for key in band_keys(signature)]
+    )
+
+
+def _index_batch(conn, rows, threshold):
+    """Index a batch of (id, title, lyrics, audio_fingerprint, updated_at) track rows"""
+    pending = []
+    stale_clusters = set()
+    for track_id, title, lyrics, audio_fingerprint, _ in rows:
+        signature = minhash_signature(shingle_track(title, lyrics, audio_fingerprint))
+        blob = pack_signature(signature)
+        previous = conn.execute(
+            'SELECT signature, cluster_id FROM track_signatures WHERE track_id = ?',
+            (track_id,)
+        ).fetchone()
+        if previous is not None:
+            if previous[0] == blob:
+                continue
+            conn.execute('DELETE FROM track_signatures WHERE track_id = ?', (track_id,))
+            stale_clusters.add(previous[1])
+        pending.append((track_id, signature, blob))
+
+    # Take changed tracks out of their old clusters before re-adding them
+    if stale_clusters:
+        _resettle(conn, stale_clusters, threshold)
+    for track_id, signature, blob in pending:
+        _add_track(conn, track_id, signature, blob, threshold)
+
+
+def _store_counts(conn, watermark):
+    """Record the watermark and the counts the site reads"""
+    unique_tracks = conn.execute('SELECT COUNT(*) FROM track_clusters').fetchone()[0]
+    cluster_count = conn.execute(
+        'SELECT COUNT(*) FROM track_clusters WHERE size > 1').fetchone()[0]
+    catalog.set_state(conn, WATERMARK_KEY, watermark)
+    catalog.set_state(conn, UNIQUE_TRACKS_KEY, unique_tracks)
+    catalog.set_state(conn, CLUSTER_COUNT_KEY, cluster_count)
+
+
+_TRACK_COLUMNS = 'SELECT id, title, lyrics, audio_fingerprint, updated_at FROM tracks '
+
+
+def _next_batch(conn, watermark, batch_size):
+    """Fetch the next tracks past the watermark without splitting an updated_at tie"""
+    rows = conn.execute(_TRACK_COLUMNS + 'WHERE updated_at > ? ORDER BY updated_at LIMIT ?',
+                        (watermark, batch_size)).fetchall()
+    if len(rows) == batch_size:
+        # The next run resumes after the watermark, so finish its timestamp here
+        last = rows[-1][-1]
+        seen = {row[0] for row in rows if row[-1] == last}
+        rows.extend(row for row in conn.execute(_TRACK_COLUMNS + 'WHERE updated_at = ?', (last,))
+                    if row[0] not in seen)
+    return rows
+
+
+def update_duplicates(conn, threshold=DEFAULT_THRESHOLD, batch_size=DEFAULT_BATCH_SIZE,
+                      on_progress=None):
+    """
+    Bring stored signatures and duplicate clusters up to date with the catalog.
+
+    Only tracks whose updated_at is past the stored watermark are shingled.
+    A new track is compared against LSH candidates already in the catalog.
+    A changed track has its old cluster regrouped, because removing a member
+    can split it. Each batch is committed together with the watermark and
+    the unique_tracks count, so an interrupted update keeps its completed
+    batches and the site only ever reads a stored value. Returns the number
+    of tracks processed.
+    """
+    watermark = catalog.get_state(conn, WATERMARK_KEY, 0.0)
+    processed = 0
+    while True:
+        rows = _next_batch(conn, watermark, batch_size)
+        if not rows:
+            break
+        with conn:
+            _index_batch(conn, rows, threshold)
+            watermark = rows[-1][-1]
+            _store_counts(conn, watermark)
+        processed += len(rows)
+        if on_progress:
+            on_progress(processed)
+    return processed
+
+
+def reset_duplicates(conn):
+    """Discard stored signatures so the next update reindexes every track"""
+    with conn:
+        conn.execute('DELETE FROM cluster_bands')
+        conn.execute('DELETE FROM track_clusters')
+        conn.execute('DELETE FROM track_signatures')
+        for key in (WATERMARK_KEY, UNIQUE_TRACKS_KEY, CLUSTER_COUNT_KEY):
+            catalog.set_state(conn, key, None)
+
+
+def duplicate_report(conn, limit=None):
+    """Build a JSON-serialisable duplicate cluster report from the stored clusters"""
+    total_tracks = conn.execute('SELECT COUNT(*) FROM track_signatures').fetchone()[0]
+    unique_tracks = int(catalog.get_state(conn, UNIQUE_TRACKS_KEY, total_tracks))
+    largest = conn.execute(
+        'SELECT cluster_id, size FROM track_clusters WHERE size > 1 '
+        'ORDER BY size DESC, cluster_id LIMIT ?',
+        (-1 if limit is None else limit,)
+    ).fetchall()
+    clusters = []
+    for cluster_id, size in largest:
+        track_ids = [
+            row[0] for row in conn.execute(
+                'SELECT track_id FROM track_signatures WHERE cluster_id = ? ORDER BY track_id',
+                (cluster_id,)
+            )
+        ]
+        title = conn.execute('SELECT title FROM tracks WHERE id = ?', (cluster_id,)).fetchone()
+        clusters.append({
+            "representative": cluster_id,
+            "title": title[0] if title else None,
+            "size": size,
+            "track_ids": track_ids
+        })
+    return {
+        "total_tracks": total_tracks,
+        "unique_tracks": unique_tracks,
+        "duplicate_tracks": total_tracks - unique_tracks,
+        "cluster_count": int(catalog.get_state(conn, CLUSTER_COUNT_KEY, 0)),
+        "clusters": clusters
+    }
+
+
+@catalog.catalog_cli.command('duplicates')
+@click.option('--limit', default=20, show_default=True, type=click.IntRange(min=0),
+              help='Number of clusters to list.')
+@click.option('--rebuild', is_flag=True,
+              help='Reindex every track, e.g. after changing DEDUP_THRESHOLD.')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              type=click.IntRange(min=1), help='Tracks per transaction.')
+def duplicates_command(limit, rebuild, batch_size):
+    """Update and report near-duplicate track clusters in the catalog."""
+    conn = catalog.get_db()
+    if rebuild:
+        reset_duplicates(conn)
+    started = time.monotonic()
+
+    def on_progress(processed):
+        elapsed = time.monotonic() - started
+        rate = processed / elapsed if elapsed else 0
+        click.echo(f'Indexed {processed:,} tracks for duplicates ({rate:,.0f}/s)', err=True)
+
+    try:
+        processed = update_duplicates(conn, current_app.config['DEDUP_THRESHOLD'], batch_size,
+                                      on_progress)
+    except KeyboardInterrupt:
+        click.echo('Update interrupted; completed batches were kept and the next run '
+                   'resumes after them.', err=True)
+        sys.exit(130)
+    click.echo(f'Duplicate index updated: {processed:,} tracks checked '
+               f'in {time.monotonic() - started:.1f}s', err=True)
+
+    report = duplicate_report(conn, limit)
+    click.echo(f"{report['total_tracks']:,} tracks, {report['unique_tracks']:,} unique, "
+               f"{report['cluster_count']:,} duplicate clusters")
+    for cluster in report['clusters']:
+        click.echo(f"  {cluster['size']:>4}  {cluster['title']}  ({cluster['representative']})")
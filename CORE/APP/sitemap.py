@@ -0,0 +1,87 @@
+"""
+AvatarArts Sitemap - streamed sitemap.xml generation for catalog pages
+Splits into sitemap-index shards when the URL count exceeds the protocol limit
+"""
+
+from datetime import datetime, timezone
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+from . import catalog
+
+# Sitemap protocol limit on URLs per file
+SITEMAP_MAX_URLS = 50000
+
+# Rows rendered per yielded chunk of XML
+CHUNK_SIZE = 1000
+
+# Placeholder substituted with each quoted key, so url_for runs once per shard
+URL_PLACEHOLDER = '__SITEMAP_KEY__'
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+URLSET_OPEN = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+INDEX_OPEN = '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+
+
+def format_lastmod(timestamp):
+    """Format a catalog updated_at timestamp as a W3C date"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+
+def max_rowid(conn, entity):
+    """
+    Highest rowid for one record type, an upper bound on its URL count.
+
+    Shards are rowid ranges, so sizing them is a single index lookup and
+    gaps left by deleted rows only ever make a shard smaller.
+    """
+    table = catalog.ENTITY_TABLES[entity]
+    return conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+
+
+def shard_count(rowid_bound, max_urls=None):
+    """Number of rowid-range shards needed to cover rowids up to rowid_bound"""
+    max_urls = max_urls or SITEMAP_MAX_URLS
+    return (rowid_bound + max_urls - 1) // max_urls
+
+
+def iter_entity_urls(conn, entity, url_template, shard=None, max_urls=None):
+    """Yield lists of (loc, lastmod) for one record type, optionally one shard"""
+    max_urls = max_urls or SITEMAP_MAX_URLS
+    fields = catalog.ENTITY_FIELDS[entity]
+    sql = f'SELECT {fields[0]}, updated_at FROM {catalog.ENTITY_TABLES[entity]}'
+    params = ()
+    if shard is not None:
+        sql += ' WHERE rowid > ? AND rowid <= ?'
+        params = (shard * max_urls, (shard + 1) * max_urls)
+    cursor = conn.execute(sql + ' ORDER BY rowid', params)
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        yield [
+            (url_template.replace(URL_PLACEHOLDER, quote(key, safe='')), format_lastmod(updated_at))
+            for key, updated_at in rows
+        ]
+
+
+def stream_urlset(url_chunks):
+    """Yield a <urlset> document from an iterable of (loc, lastmod) lists"""
+    yield XML_HEADER + URLSET_OPEN
+    for chunk in url_chunks:
+        parts = []
+        for loc, lastmod in chunk:
+            if lastmod:
+                parts.append(f'<url><loc>{escape(loc)}</loc><lastmod>{lastmod}</lastmod></url>\n')
+            else:
+                parts.append(f'<url><loc>{escape(loc)}</loc></url>\n')
+        yield ''.join(parts)
+    yield '</urlset>\n'
+
+
+def stream_index(shard_locs):
+    """Yield a <sitemapindex> document listing shard URLs"""
+    yield XML_HEADER + INDEX_OPEN
+    for loc in shard_locs:
+        yield f'<sitemap><loc>{escape(loc)}</loc></sitemap>\n'
+    yield '</sitemapindex>\n'
@@ -0,0 +1,3 @@
+"""
+AvatarArts Website core package
+"""
@@ -117,7 +117,7 @@ echo "   source $PROJECT_ROOT/venv/bin/activate"
 echo "2. Navigate to the project directory:"
 echo "   cd $PROJECT_ROOT"
 echo "3. Run the development server:"
-echo "   python CORE/APP/app.py"
+echo "   python -m CORE.APP.app"
 echo "4. Visit http://localhost:5000 in your browser"
 echo ""
 
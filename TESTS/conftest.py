@@ -0,0 +1,43 @@
+"""
+Shared fixtures for the AvatarArts website tests
+"""
+
+import os
+import sys
+
+import pytest
+
+# The site is imported as the CORE.APP package from the project root
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from CORE.APP import catalog  # noqa: E402
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """A fresh catalog database"""
+    connection = catalog.connect(str(tmp_path / 'catalog.db'))
+    yield connection
+    connection.close()
+
+
+@pytest.fixture
+def cli(tmp_path, monkeypatch):
+    """Invoke `flask catalog ...` against a fresh catalog database"""
+    from CORE.APP import app as site
+
+    monkeypatch.setitem(site.app.config, 'CATALOG_DATABASE', str(tmp_path / 'cli.db'))
+    runner = site.app.test_cli_runner()
+
+    def invoke(*args, input=None):
+        return runner.invoke(args=['catalog', *args], input=input)
+
+    invoke.app = site.app
+    return invoke
+
+
+def import_all(conn, records, default_type=None):
+    """Import plain record dicts, numbering them like lines of a file"""
+    return catalog.import_records(conn, enumerate(records, 1), default_type)
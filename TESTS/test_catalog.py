@@ -0,0 +1,246 @@
+"""
+Tests for catalog import validation and upsert behaviour
+"""
+
+import io
+import json
+
+import pytest
+
+from CORE.APP import catalog
+from conftest import import_all
+
+
+@pytest.mark.parametrize('record', [
+    {'type': 'track', 'id': 't1', 'title': 'X', 'duration_seconds': 'inf'},
+    {'type': 'track', 'id': 't1', 'title': 'X', 'duration_seconds': float('nan')},
+    {'type': 'track', 'id': 't1', 'title': 'X', 'duration_seconds': -5},
+    {'type': 'track', 'id': {'x': 1}, 'title': 'X'},
+    {'type': 'track', 'id': 't1', 'title': ['X']},
+    {'type': 'track', 'id': 't1', 'title': True},
+    {'type': 'track', 'id': 'x/y', 'title': 'X'},
+    {'type': 'track', 'id': 't1', 'title': 'X', 'album_id': '../a'},
+    {'type': 'track', 'id': 't1', 'title': 'X', 'collection': 'Not A Slug'},
+    {'type': 'album', 'id': 'a1', 'title': 'A', 'track_count': 1.5},
+    {'type': 'album', 'id': 'a1', 'title': 'A', 'track_count': -1},
+    {'type': 'album', 'id': 'a1', 'title': 'A', 'track_count': 99999999999999999999},
+    {'type': 'album', 'id': 'a1', 'title': 'A', 'track_count': '9223372036854775808'},
+    {'type': 'track', 'id': 't1', 'title': '\ud800'},
+    {'type': 'track', 'id': 't1', 'title': 'X', 'lyrics': 'la \udfff la'},
+    {'type': 'collection', 'slug': 'Alley Chronicles', 'name': 'Alley'},
+    {'type': 'track', 'title': 'missing id'},
+    {'type': 'playlist', 'id': 'p1'},
+    ['not', 'an', 'object'],
+])
+def test_invalid_records_are_rejected(conn, record):
+    errors = []
+    stats = catalog.import_records(conn, [(1, record)],
+                                   on_error=lambda line, error: errors.append(line))
+    assert stats == {'imported': 0, 'rejected': 1}
+    assert errors == [1]
+    assert catalog.get_catalog_counts(conn) == {'collection': 0, 'album': 0, 'track': 0}
+
+
+def test_unstorable_values_do_not_abort_the_batch(conn):
+    records = [
+        (1, {'type': 'album', 'id': 'a1', 'title': 'A', 'track_count': 2 ** 63 - 1}),
+        (2, {'type': 'album', 'id': 'a2', 'title': 'A', 'track_count': 2 ** 63}),
+        (3, json.loads('{"type": "track", "id": "t1", "title": "\\ud800"}')),
+        (4, {'type': 'track', 'id': 't2', 'title': 'Summer Love'}),
+    ]
+    errors = []
+    stats = catalog.import_records(conn, records, on_error=lambda line, error: errors.append(line))
+    assert stats == {'imported': 2, 'rejected': 2}
+    assert errors == [2, 3]
+    assert catalog.get_catalog_counts(conn) == {'collection': 0, 'album': 1, 'track': 1}
+
+
+def test_csv_strings_are_coerced(conn):
+    stream = io.StringIO(
+        'id,title,album_id,duration_seconds,genre\n'
+        'T-1.a,  Willow Whispers ,a1,185.5,\n'
+    )
+    stats = catalog.import_records(conn, catalog.read_csv(stream), default_type='track')
+    assert stats == {'imported': 1, 'rejected': 0}
+    track = catalog.get_entity(conn, 'track', 'T-1.a')
+    assert track['title'] == 'Willow Whispers'
+    assert track['duration_seconds'] == 185.5
+    assert track['genre'] is None
+
+
+def test_invalid_json_lines_are_rejected():
+    stream = io.StringIO('{"type": "track", "id": "t1", "title": "X"}\n{bad\n\n')
+    records = list(catalog.read_ndjson(stream))
+    assert records[0] == (1, {'type': 'track', 'id': 't1', 'title': 'X'})
+    assert isinstance(records[1][1], catalog.CatalogRecordError)
+
+
+def test_reimporting_identical_data_keeps_updated_at(conn):
+    record = {'type': 'track', 'id': 't1', 'title': 'Summer Love', 'duration_seconds': 200}
+    import_all(conn, [record])
+    first = catalog.get_entity(conn, 'track', 't1')['updated_at']
+
+    import_all(conn, [dict(record)])
+    assert catalog.get_entity(conn, 'track', 't1')['updated_at'] == first
+
+    import_all(conn, [dict(record, title='Summer Love (Remix)')])
+    updated = catalog.get_entity(conn, 'track', 't1')
+    assert updated['title'] == 'Summer Love (Remix)'
+    assert updated['updated_at'] > first
+
+
+def test_batches_are_committed_independently(conn):
+    records = [{'type': 'track', 'id': f't{i}', 'title': f'Track {i}'} for i in range(5)]
+    progress = []
+    stats = catalog.import_records(conn, enumerate(records, 1), batch_size=2,
+                                   on_progress=lambda s: progress.append(s['imported']))
+    assert stats['imported'] == 5
+    assert progress == [2, 4, 5]
+    assert catalog.get_catalog_counts(conn)['track'] == 5
+
+
+def test_export_rows_round_trip(conn):
+    import_all(conn, [
+        {'type': 'collection', 'slug': 'alley_chronicles', 'name': 'Alley Chronicles',
+         'track_count': 151},
+        {'type': 'album', 'id': 'a1', 'title': 'In This Alley', 'collection': 'alley_chronicles'},
+    ])
+    rows = [dict(row, type=entity) for entity in catalog.ENTITY_FIELDS
+            for row in catalog.iter_rows(conn, entity)]
+    lines = [json.dumps(row) for row in rows]
+    records = [json.loads(line) for line in lines]
+    assert [catalog.validate_record(record)[0] for record in records] == ['collection', 'album']
+
+
+def test_schema_is_created_once_per_database(tmp_path, monkeypatch):
+    calls = []
+    init_db = catalog.init_db
+    monkeypatch.setattr(catalog, 'init_db', lambda conn: calls.append(conn) or init_db(conn))
+    path = str(tmp_path / 'once.db')
+    for _ in range(3):
+        conn = catalog.connect(path)
+        assert catalog.get_catalog_counts(conn) == {'collection': 0, 'album': 0, 'track': 0}
+        conn.close()
+    assert len(calls) == 1
+
+
+# `flask catalog import` / `export`
+
+CATALOG_RECORDS = [
+    {'type': 'collection', 'slug': 'alley_chronicles', 'name': 'Alley Chronicles',
+     'track_count': 151, 'primary_theme': 'Urban Mythology'},
+    {'type': 'album', 'id': 'a1', 'title': 'In This Alley', 'collection': 'alley_chronicles',
+     'track_count': 2},
+    {'type': 'track', 'id': 't1', 'title': 'In This Alley Where I Hide', 'album_id': 'a1',
+     'duration_seconds': 185.5, 'lyrics': 'Line one\nLine "two", with commas'},
+    {'type': 'track', 'id': 't2', 'title': '朝の歌', 'album_id': 'a1', 'mood': 'calm'},
+]
+
+
+def use_database(cli, path):
+    cli.app.config['CATALOG_DATABASE'] = str(path)
+
+
+def dump(path):
+    conn = catalog.connect(str(path))
+    try:
+        return {entity: [dict(row) for row in catalog.iter_rows(conn, entity)]
+                for entity in catalog.ENTITY_FIELDS}
+    finally:
+        conn.close()
+
+
+def write_ndjson(path, records):
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records), encoding='utf-8')
+
+
+def test_cli_ndjson_round_trip(cli, tmp_path):
+    source = tmp_path / 'catalog.ndjson'
+    write_ndjson(source, CATALOG_RECORDS)
+    result = cli('import', str(source))
+    assert result.exit_code == 0, result.output
+    assert 'Done: 4 imported, 0 rejected' in result.output
+
+    exported = tmp_path / 'export.ndjson'
+    result = cli('export', str(exported))
+    assert result.exit_code == 0, result.output
+    assert [json.loads(line) for line in exported.read_text(encoding='utf-8').splitlines()] == \
+        CATALOG_RECORDS
+
+    use_database(cli, tmp_path / 'copy.db')
+    assert cli('import', str(exported)).exit_code == 0
+    assert dump(tmp_path / 'copy.db') == dump(tmp_path / 'cli.db')
+
+
+def test_cli_csv_round_trip(cli, tmp_path):
+    source = tmp_path / 'catalog.ndjson'
+    write_ndjson(source, CATALOG_RECORDS)
+    assert cli('import', str(source)).exit_code == 0
+
+    exported = tmp_path / 'tracks.csv'
+    result = cli('export', '--type', 'track', str(exported))
+    assert result.exit_code == 0, result.output
+    assert 'Exported 2 records' in result.output
+
+    use_database(cli, tmp_path / 'copy.db')
+    result = cli('import', '--type', 'track', str(exported))
+    assert result.exit_code == 0, result.output
+    assert dump(tmp_path / 'copy.db')['track'] == dump(tmp_path / 'cli.db')['track']
+
+
+def test_cli_csv_export_needs_a_type(cli, tmp_path):
+    result = cli('export', str(tmp_path / 'all.csv'))
+    assert result.exit_code == 2
+    assert 'CSV export needs --type' in result.output
+    assert cli('export', '--format', 'csv').exit_code == 2
+
+
+def test_cli_streams_stdin_and_stdout(cli, tmp_path):
+    result = cli('import', '--format', 'csv', '--type', 'album', '-',
+                 input='id,title,track_count\na1,In This Alley,2\na2,Willow Whispers,\n')
+    assert result.exit_code == 0, result.output
+
+    result = cli('export', '--format', 'csv', '--type', 'album', '-')
+    assert result.exit_code == 0, result.output
+    assert result.stdout.splitlines() == [
+        'id,title,collection,theme,track_count',
+        'a1,In This Alley,,,2',
+        'a2,Willow Whispers,,,',
+    ]
+
+    result = cli('export', '--type', 'album')
+    assert [json.loads(line)['id'] for line in result.stdout.splitlines()] == ['a1', 'a2']
+
+
+def test_cli_format_option_overrides_the_extension(cli, tmp_path):
+    source = tmp_path / 'albums.txt'
+    source.write_text('id,title\na1,In This Alley\n', encoding='utf-8')
+    assert cli('import', str(source)).exit_code == 1
+    assert cli('import', '--format', 'csv', '--type', 'album', str(source)).exit_code == 0
+    assert [row['id'] for row in dump(tmp_path / 'cli.db')['album']] == ['a1']
+
+
+def test_cli_import_exits_nonzero_on_rejected_rows(cli, tmp_path):
+    source = tmp_path / 'tracks.ndjson'
+    source.write_text('{"type": "track", "id": "t1", "title": "Summer Love"}\n'
+                      '{"type": "track", "id": "x/y", "title": "Bad id"}\n'
+                      '{broken\n', encoding='utf-8')
+    result = cli('import', str(source))
+    assert result.exit_code == 1
+    assert 'Line 2: invalid id' in result.output
+    assert 'Line 3: invalid JSON' in result.output
+    assert 'Done: 1 imported, 2 rejected' in result.output
+    assert [row['id'] for row in dump(tmp_path / 'cli.db')['track']] == ['t1']
+
+
+def test_cli_import_interrupt_keeps_completed_batches(cli, tmp_path, monkeypatch):
+    def interrupted(stream):
+        for line_number in range(1, 4):
+            yield line_number, {'type': 'track', 'id': f't{line_number}', 'title': 'Summer Love'}
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(catalog, 'read_ndjson', interrupted)
+    result = cli('import', '--batch-size', '2', '-', input='')
+    assert result.exit_code == 130
+    assert 'Import interrupted' in result.output
+    assert [row['id'] for row in dump(tmp_path / 'cli.db')['track']] == ['t1', 't2']
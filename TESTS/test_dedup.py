@@ -0,0 +1,196 @@
+"""
+Tests for near-duplicate detection and the stored duplicate clusters
+"""
+
+import json
+
+import pytest
+
+from CORE.APP import catalog
+from CORE.APP import dedup
+from conftest import import_all
+
+DISTINCT_TITLES = ['Summer Love', 'Neon Dreams', 'Willow Whispers', 'Junkyard Symphony',
+                   'Hero Rising']
+
+# Low enough that a track sharing two thirds of its shingles still matches
+BRIDGE_THRESHOLD = 0.55
+
+
+def fingerprint(start, count):
+    """An audio fingerprint made of `count` distinct 16-character chunks"""
+    return ''.join(f'{value:016x}' for value in range(start, start + count))
+
+
+def track(track_id, title, **fields):
+    return dict({'type': 'track', 'id': track_id, 'title': title}, **fields)
+
+
+def clusters(conn):
+    rows = conn.execute('SELECT track_id, cluster_id FROM track_signatures ORDER BY track_id')
+    return {track_id: cluster_id for track_id, cluster_id in rows}
+
+
+def stored_counts(conn):
+    return (catalog.get_state(conn, dedup.UNIQUE_TRACKS_KEY),
+            catalog.get_state(conn, dedup.CLUSTER_COUNT_KEY))
+
+
+def test_normalization_keeps_non_latin_titles_apart(conn):
+    import_all(conn, [
+        track('t1', '夜'),
+        track('t2', '朝の歌'),
+        track('t3', 'Любовь'),
+        track('t4', 'Ночь'),
+        track('t5', 'Summer Love'),
+        track('t6', 'SUMMER   love!'),
+    ])
+    dedup.update_duplicates(conn)
+    assert dedup.normalize_text('Любовь!') == 'любовь'
+    assert clusters(conn) == {'t1': 't1', 't2': 't2', 't3': 't3', 't4': 't4',
+                              't5': 't5', 't6': 't5'}
+    assert stored_counts(conn) == (5, 1)
+
+
+def test_empty_shingle_sets_never_match(conn):
+    import_all(conn, [track('t1', '???'), track('t2', '!!!'), track('t3', '...')])
+    assert dedup.minhash_signature(dedup.shingle_track('???')) is None
+    dedup.update_duplicates(conn)
+    assert stored_counts(conn) == (3, 0)
+    assert conn.execute('SELECT COUNT(*) FROM cluster_bands').fetchone()[0] == 0
+
+
+def test_update_only_processes_changed_tracks(conn):
+    import_all(conn, [track('t1', 'Willow Whispers'), track('t2', 'Summer Love')])
+    assert dedup.update_duplicates(conn) == 2
+    assert stored_counts(conn) == (2, 0)
+
+    import_all(conn, [track('t1', 'Willow Whispers'), track('t2', 'Summer Love')])
+    assert dedup.update_duplicates(conn) == 0
+
+    # A later edit is picked up through the watermark and joins t1's cluster
+    import_all(conn, [track('t2', 'WILLOW WHISPERS!')])
+    assert dedup.update_duplicates(conn) == 1
+    assert clusters(conn) == {'t1': 't1', 't2': 't1'}
+    assert stored_counts(conn) == (1, 1)
+
+
+def test_editing_a_bridging_track_splits_its_cluster(conn):
+    # t1 and t3 only overlap through t2, which holds both of their fingerprints
+    import_all(conn, [
+        track('t1', 'x', audio_fingerprint=fingerprint(0, 60)),
+        track('t2', 'x', audio_fingerprint=fingerprint(0, 90)),
+        track('t3', 'x', audio_fingerprint=fingerprint(30, 60)),
+        track('t4', 'Summer Love'),
+    ])
+    dedup.update_duplicates(conn, BRIDGE_THRESHOLD)
+    assert clusters(conn) == {'t1': 't1', 't2': 't1', 't3': 't1', 't4': 't4'}
+    assert stored_counts(conn) == (2, 1)
+
+    import_all(conn, [track('t2', 'Willow Whispers')])
+    assert dedup.update_duplicates(conn, BRIDGE_THRESHOLD) == 1
+    assert clusters(conn) == {'t1': 't1', 't2': 't2', 't3': 't3', 't4': 't4'}
+    assert stored_counts(conn) == (4, 0)
+
+
+def test_rebuild_matches_incremental_clusters(conn):
+    import_all(conn, [track(f't{i}', title) for i, title in enumerate([
+        'In This Alley Where I Hide', 'In This Alley Where I Hide (Remix)',
+        'Willow Whispers', 'willow whispers!', 'Summer Love',
+    ])])
+    dedup.update_duplicates(conn)
+    incremental = clusters(conn)
+
+    dedup.reset_duplicates(conn)
+    assert catalog.get_state(conn, dedup.UNIQUE_TRACKS_KEY) is None
+    assert dedup.update_duplicates(conn) == 5
+    assert clusters(conn) == incremental
+
+    report = dedup.duplicate_report(conn)
+    assert report['unique_tracks'] == 3
+    assert [cluster['track_ids'] for cluster in report['clusters']] == [['t0', 't1'], ['t2', 't3']]
+
+
+def test_work_scales_with_clusters_not_duplicates(conn, monkeypatch):
+    comparisons = []
+    estimate = dedup.estimate_similarity
+    monkeypatch.setattr(dedup, 'estimate_similarity',
+                        lambda a, b: comparisons.append(1) or estimate(a, b))
+    count = 1000
+    # Descending ids: each new track sorts before the id of the cluster it joins
+    import_all(conn, [track(f't{i:04d}', 'Intro') for i in reversed(range(count))])
+    changes = conn.total_changes
+    assert dedup.update_duplicates(conn) == count
+    assert stored_counts(conn) == (1, 1)
+    assert len(comparisons) < 2 * count
+    assert conn.total_changes - changes < 50 * count
+    assert conn.execute('SELECT COUNT(*) FROM cluster_bands').fetchone()[0] == dedup.NUM_BANDS
+
+    # Editing part of the cluster regroups it once, not once per edited track
+    del comparisons[:]
+    import_all(conn, [track(f't{i:04d}', 'Outro') for i in range(0, count, 10)])
+    assert dedup.update_duplicates(conn) == count // 10
+    assert stored_counts(conn) == (2, 2)
+    assert len(comparisons) < 2 * count
+    assert dedup.duplicate_report(conn)['clusters'][0]['size'] == count - count // 10
+
+
+def test_batches_are_committed_as_they_complete(conn):
+    import_all(conn, [track(f't{i}', title) for i, title in enumerate(DISTINCT_TITLES)])
+    progress = []
+
+    def interrupt(processed):
+        progress.append(processed)
+        if processed == 2:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        dedup.update_duplicates(conn, batch_size=2, on_progress=interrupt)
+    assert progress == [2]
+    assert stored_counts(conn) == (2, 0)
+
+    # The rerun resumes after the committed batch
+    assert dedup.update_duplicates(conn, batch_size=2, on_progress=progress.append) == 3
+    assert progress == [2, 2, 3]
+    assert stored_counts(conn) == (5, 0)
+
+
+def test_batches_never_split_an_updated_at_tie(conn):
+    import_all(conn, [track(f't{i}', title) for i, title in enumerate(DISTINCT_TITLES)])
+    with conn:
+        conn.execute("UPDATE tracks SET updated_at = 1.0 WHERE id IN ('t1', 't2', 't3')")
+        conn.execute("UPDATE tracks SET updated_at = 0.5 WHERE id = 't0'")
+    progress = []
+    assert dedup.update_duplicates(conn, batch_size=2, on_progress=progress.append) == 5
+    assert progress == [4, 5]
+    assert dedup.update_duplicates(conn, batch_size=2) == 0
+
+
+def test_duplicates_command_runs_separately_from_import(cli, tmp_path):
+    source = tmp_path / 'tracks.ndjson'
+    source.write_text(''.join(json.dumps(record) + '\n' for record in [
+        track('t1', 'Summer Love'), track('t2', 'summer love!'), track('t3', 'Neon Dreams'),
+    ]), encoding='utf-8')
+    result = cli('import', str(source))
+    assert result.exit_code == 0, result.output
+    assert "Run 'flask catalog duplicates'" in result.output
+
+    conn = catalog.connect(cli.app.config['CATALOG_DATABASE'])
+    try:
+        assert stored_counts(conn) == (None, None)
+        result = cli('duplicates', '--batch-size', '2')
+        assert result.exit_code == 0, result.output
+        assert 'Duplicate index updated: 3 tracks checked' in result.output
+        assert '3 tracks, 2 unique, 1 duplicate clusters' in result.output
+        assert stored_counts(conn) == (2, 1)
+    finally:
+        conn.close()
+
+
+def test_find_clusters_groups_in_memory_signatures():
+    signatures = {
+        track_id: dedup.minhash_signature(dedup.shingle_track(title))
+        for track_id, title in [('b', 'Neon Dreams'), ('a', 'Neon Dreams!'),
+                                ('c', 'Willow Whispers'), ('d', '')]
+    }
+    assert dedup.find_clusters(signatures) == {'a': 'a', 'b': 'a', 'c': 'c', 'd': 'd'}
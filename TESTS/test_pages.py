@@ -0,0 +1,156 @@
+"""
+Tests for the catalog detail pages, their page cache and the sitemap
+"""
+
+import os
+import re
+
+import pytest
+from jinja2 import ChoiceLoader, DictLoader, FileSystemLoader, PrefixLoader
+
+from CORE.APP import catalog
+from CORE.APP import sitemap
+from conftest import import_all
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TEMPLATES')
+
+
+@pytest.fixture
+def app(tmp_path):
+    """The site app on an empty catalog, with templates resolved from TEMPLATES/"""
+    from CORE.APP import app as site
+
+    site.app.config.update(TESTING=True, CATALOG_DATABASE=str(tmp_path / 'catalog.db'))
+    loader = site.app.jinja_loader
+    site.app.jinja_loader = ChoiceLoader([
+        FileSystemLoader(os.path.join(TEMPLATES_DIR, 'PAGES')),
+        PrefixLoader({'layouts': FileSystemLoader(os.path.join(TEMPLATES_DIR, 'LAYOUTS'))}),
+        DictLoader({'404.html': 'Not found', '500.html': 'Server error'}),
+    ])
+    site.app.jinja_env.cache.clear()
+    site._page_cache.clear()
+    yield site.app
+    site.app.jinja_loader = loader
+    site.app.jinja_env.cache.clear()
+    site._page_cache.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def load(app, records):
+    with app.app_context():
+        import_all(catalog.get_db(), records)
+
+
+ALBUM = {'type': 'album', 'id': 'a1', 'title': 'In This Alley', 'collection': 'alley_chronicles'}
+TRACK = {'type': 'track', 'id': 't1', 'title': 'Neon Dreams', 'album_id': 'a1'}
+
+
+def test_unchanged_page_is_not_modified(app, client):
+    load(app, [ALBUM, TRACK])
+    first = client.get('/track/t1')
+    assert first.status_code == 200
+    assert b'Neon Dreams' in first.data
+
+    again = client.get('/track/t1', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_track_update_refreshes_page(app, client):
+    load(app, [ALBUM, TRACK])
+    etag = client.get('/track/t1').headers['ETag']
+
+    load(app, [dict(TRACK, title='Neon Dreams (Remix)')])
+    response = client.get('/track/t1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Neon Dreams (Remix)' in response.data
+
+
+def test_album_rename_refreshes_track_page(app, client):
+    load(app, [ALBUM, TRACK])
+    etag = client.get('/track/t1').headers['ETag']
+
+    load(app, [dict(ALBUM, title='Back In The Alley')])
+    response = client.get('/track/t1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Back In The Alley' in response.data
+
+
+def test_album_pages_list_new_tracks(app, client):
+    load(app, [ALBUM, TRACK])
+    etag = client.get('/album/a1').headers['ETag']
+
+    load(app, [dict(TRACK, id='t2', title='Willow Whispers')])
+    response = client.get('/album/a1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Willow Whispers' in response.data
+    assert client.get('/album/a1?page=2').status_code == 404
+
+
+@pytest.mark.parametrize('page', ['abc', '0', '-1', '+1', ' 1', '1_0', '1.0', '', '9' * 50])
+def test_invalid_page_numbers_are_not_found(app, client, page):
+    from CORE.APP import app as site
+
+    load(app, [ALBUM, TRACK])
+    assert client.get(f'/album/a1?page={page}').status_code == 404
+    assert client.get(f'/collection/alley_chronicles?page={page}').status_code == 404
+    assert not site._page_cache
+    assert client.get('/album/a1?page=1').status_code == 200
+    assert list(site._page_cache) == [('album', 'a1', 1)]
+
+
+def test_unknown_entities_are_not_found(client):
+    assert client.get('/track/missing').status_code == 404
+    assert client.get('/album/missing').status_code == 404
+    assert client.get('/collection/missing').status_code == 404
+
+
+def test_listing_keeps_builtin_collections_after_import(app, client):
+    from CORE.APP import app as site
+
+    load(app, [{'type': 'collection', 'slug': 'neon_nights', 'name': 'Neon Nights'},
+               {'type': 'collection', 'slug': 'alley_chronicles', 'name': 'Alley Chronicles II'}])
+    with app.app_context():
+        collections = site.get_special_collections()
+    assert set(collections) == set(app.config['SPECIAL_COLLECTIONS']) | {'neon_nights'}
+    assert collections['alley_chronicles']['name'] == 'Alley Chronicles II'
+    for slug in collections:
+        assert client.get(f'/collection/{slug}').status_code == 200
+
+
+def sitemap_locs(response):
+    return re.findall(r'<loc>http://localhost(/[^<]*)</loc>', response.get_data(as_text=True))
+
+
+def test_sitemap_lists_every_collection_page(app, client):
+    load(app, [{'type': 'collection', 'slug': 'alley_chronicles', 'name': 'Alley Chronicles'},
+               {'type': 'collection', 'slug': 'neon_nights', 'name': 'Neon Nights'},
+               ALBUM, TRACK])
+    response = client.get('/sitemap.xml')
+    assert response.status_code == 200
+    locs = sitemap_locs(response)
+    assert len(locs) == len(set(locs))
+    collections = {loc for loc in locs if loc.startswith('/collection/')}
+    assert collections == {f'/collection/{slug}'
+                           for slug in set(app.config['SPECIAL_COLLECTIONS']) | {'neon_nights'}}
+    assert {'/album/a1', '/track/t1'} <= set(locs)
+
+
+def test_large_sitemaps_are_split_into_shards(app, client, monkeypatch):
+    monkeypatch.setattr(sitemap, 'SITEMAP_MAX_URLS', 2)
+    load(app, [ALBUM] + [dict(TRACK, id=f't{i}') for i in range(5)])
+
+    index = client.get('/sitemap.xml')
+    assert b'<sitemapindex' in index.data
+    assert sitemap_locs(index) == ['/sitemap-pages-0.xml', '/sitemap-album-0.xml'] + \
+        [f'/sitemap-track-{shard}.xml' for shard in range(3)]
+
+    track_locs = []
+    for shard in range(3):
+        track_locs.extend(sitemap_locs(client.get(f'/sitemap-track-{shard}.xml')))
+    assert track_locs == [f'/track/t{i}' for i in range(5)]
+    assert client.get('/sitemap-track-3.xml').status_code == 404
+    assert client.get('/sitemap-pages-1.xml').status_code == 404
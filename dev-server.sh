@@ -20,9 +20,8 @@ fi
 # Start the Flask application
 echo "Starting AvatarArts website on http://localhost:8080"
 echo "Press Ctrl+C to stop the server"
-cd CORE/APP/
 python -c "
-from app import app
+from CORE.APP.app import app
 print('AvatarArts Website is running on http://localhost:8080')
 print('Press Ctrl+C to stop the server')
 try: